@@ -6,10 +6,12 @@ from pathlib import Path
 import sys
 import time
 
-from download_failed_naip import download_failed_naip
 from download_naip import download_naip
 from download_osm import download_osm
 from polygons_to_mask_tiles import polygons_to_mask_tiles
+from tile_index import load_blank_tiles
+
+logger = logging.getLogger(__name__)
 
 
 def setup_logging(log_level: str = "INFO") -> None:
@@ -39,19 +41,19 @@ def validate_bbox(bbox: tuple[float, float, float, float]) -> bool:
     west, south, east, north = bbox
 
     if not (-180 <= west <= 180 and -180 <= east <= 180):
-        logging.error(f"Invalid longitude values: west={west}, east={east}")
+        logger.error("Invalid longitude values: west=%s, east=%s", west, east)
         return False
 
     if not (-90 <= south <= 90 and -90 <= north <= 90):
-        logging.error(f"Invalid latitude values: south={south}, north={north}")
+        logger.error("Invalid latitude values: south=%s, north=%s", south, north)
         return False
 
     if west >= east:
-        logging.error(f"West longitude ({west}) must be less than east longitude ({east})")
+        logger.error("West longitude (%s) must be less than east longitude (%s)", west, east)
         return False
 
     if south >= north:
-        logging.error(f"South latitude ({south}) must be less than north latitude ({north})")
+        logger.error("South latitude (%s) must be less than north latitude (%s)", south, north)
         return False
 
     return True
@@ -62,42 +64,29 @@ def download_naip_imagery(
     zoom: int,
     output_dir: Path,
     max_workers: int = 16,
-    max_retries: int = 2,
+    max_retries: int = 3,
 ) -> bool:
-    """Download NAIP imagery, with automatic retries"""
-    logging.info(f"Starting NAIP imagery download for bbox={bbox}")
+    """Download NAIP imagery, retrying transient failures per tile"""
+    logger.info("Starting NAIP imagery download for bbox=%s", bbox)
     naip_dir = output_dir / "naip_tiles"
 
     try:
-        # initial download
-        logging.info("Initial NAIP download started")
-        download_naip(bbox, zoom, naip_dir, max_workers=max_workers)
-
-        failed_file = naip_dir / "failed_tiles.txt"
-        retry_count = 0
-
-        while failed_file.exists() and retry_count < max_retries:
-            retry_count += 1
-            logging.info(f"Retrying NAIP download ({retry_count}/{max_retries})")
-
-            backup_file = naip_dir / f"failed_tiles_backup_{retry_count}.txt"
-            failed_file.rename(backup_file)
-
-            download_failed_naip(str(backup_file), naip_dir)
-
-            if not failed_file.exists():
-                logging.info("NAIP download completed successfully")
-                return True
-
-            if failed_file.exists():
-                logging.error(f"Some NAIP tiles still failed after {retry_count} retries. Check {failed_file}")
-                return False
+        failed_tiles = download_naip(bbox, zoom, naip_dir, max_workers=max_workers, max_retries=max_retries)
+
+        if failed_tiles:
+            logger.error(
+                "%s NAIP tiles still failed after %s retries. Check %s",
+                len(failed_tiles),
+                max_retries,
+                naip_dir / "failed_tiles.txt",
+            )
+            return False
 
-        logging.info("NAIP imagery download completed successfully")
+        logger.info("NAIP imagery download completed successfully")
         return True
 
     except Exception as e:
-        logging.error(f"Error downloading NAIP imagery: {e}")
+        logger.error("Error downloading NAIP imagery: %s", e)
         return False
 
 
@@ -108,7 +97,7 @@ def download_forest_polygons(
 ) -> bool:
     """Download forest polygons from OpenStreetMap"""
 
-    logging.info(f"Downloading forest polygons for bbox: {bbox}")
+    logger.info("Downloading forest polygons for bbox: %s", bbox)
     polygons_file = output_dir / "forest_polygons.geojson"
 
     try:
@@ -116,14 +105,14 @@ def download_forest_polygons(
         download_osm(bbox, tag_key, tag_value, polygons_file)
 
         if not polygons_file.exists():
-            logging.error("Forest polygons file was not created")
+            logger.error("Forest polygons file was not created")
             return False
 
-        logging.info(f"Forest polygons saved to: {polygons_file}")
+        logger.info("Forest polygons saved to: %s", polygons_file)
         return True
 
     except Exception as e:
-        logging.error(f"Error downloading forest polygons: {e}")
+        logger.error("Error downloading forest polygons: %s", e)
         return False
 
 
@@ -131,22 +120,24 @@ def create_mask_tiles(
     naip_dir: Path,
     polygons_file: Path,
     output_dir: Path,
+    bbox: tuple[float, float, float, float],
+    zoom: int,
 ) -> bool:
     """Create mask tiles from forest polygons"""
-    logging.info("Creating mask tiles from forest polygons")
+    logger.info("Creating mask tiles from forest polygons")
     masks_dir = output_dir / "mask_tiles"
 
     try:
-        polygons_to_mask_tiles(naip_dir, polygons_file, masks_dir)
+        polygons_to_mask_tiles(naip_dir, polygons_file, masks_dir, bbox=bbox, zoom=zoom)
         mask_files = list(masks_dir.glob("*_mask.tif"))
         if not mask_files:
-            logging.error("No mask tiles were created")
+            logger.error("No mask tiles were created")
             return False
-        logging.info(f"Created {len(mask_files)} mask tiles in {masks_dir}")
+        logger.info("Created %s mask tiles in %s", len(mask_files), masks_dir)
         return True
 
     except Exception as e:
-        logging.error(f"Error creating mask tiles: {e}")
+        logger.error("Error creating mask tiles: %s", e)
         return False
 
 
@@ -160,18 +151,25 @@ def verify_outputs(output_dir: Path) -> bool:
     naip_files = list(naip_dir.glob("*.png")) if naip_dir.exists() else []
     mask_files = list(masks_dir.glob("*_mask.tif")) if masks_dir.exists() else []
 
-    logging.info("Pipeline Results:")
-    logging.info(f"  • NAIP tiles: {len(naip_files)}")
-    logging.info(f"  • Mask tiles: {len(mask_files)}")
-    logging.info(f"  • Forest polygons: {'✓' if polygons_file.exists() else '✗'}")
+    logger.info("Pipeline Results:")
+    logger.info("  • NAIP tiles: %s", len(naip_files))
+    logger.info("  • Mask tiles: %s", len(mask_files))
+    logger.info("  • Forest polygons: %s", "✓" if polygons_file.exists() else "✗")
+
+    # blank NAIP tiles are skipped when creating masks
+    blank_tiles = load_blank_tiles(naip_dir) if naip_dir.exists() else set()
+    if blank_tiles:
+        logger.info("  • Blank NAIP tiles: %s", len(blank_tiles))
 
-    if len(naip_files) != len(mask_files):
-        logging.warning(f"Mismatch: {len(naip_files)} NAIP tiles vs {len(mask_files)} mask tiles")
+    if len(naip_files) - len(blank_tiles) != len(mask_files):
+        logger.warning(
+            "Mismatch: %s non-blank NAIP tiles vs %s mask tiles", len(naip_files) - len(blank_tiles), len(mask_files)
+        )
 
     # Check for any remaining failed tiles
     failed_files = list(naip_dir.glob("*failed*.txt")) if naip_dir.exists() else []
     if failed_files:
-        logging.warning(f"Found {len(failed_files)} failed tile logs")
+        logger.warning("Found %s failed tile logs", len(failed_files))
 
 
 def data_pipeline(
@@ -179,7 +177,7 @@ def data_pipeline(
     output_dir: Path,
     zoom: int = 17,
     max_workers: int = 16,
-    max_retries: int = 2,
+    max_retries: int = 3,
     osm_tag: str = "natural=wood",
     log_level: str = "INFO",
     skip_naip: bool = False,
@@ -197,13 +195,13 @@ def data_pipeline(
     output_dir = create_output_subdir(output_dir, bbox)
 
     # Log pipeline start
-    logging.info("=" * 60)
-    logging.info("🌲 Forest Trace Data Pipeline Starting")
-    logging.info("=" * 60)
-    logging.info(f"Bounding box: {bbox}")
-    logging.info(f"Zoom level: {zoom}")
-    logging.info(f"Output directory: {output_dir.absolute()}")
-    logging.info(f"OSM tag: {osm_tag}")
+    logger.info("=" * 60)
+    logger.info("🌲 Forest Trace Data Pipeline Starting")
+    logger.info("=" * 60)
+    logger.info("Bounding box: %s", bbox)
+    logger.info("Zoom level: %s", zoom)
+    logger.info("Output directory: %s", output_dir.absolute())
+    logger.info("OSM tag: %s", osm_tag)
 
     start_time = time.time()
     success = True
@@ -211,62 +209,62 @@ def data_pipeline(
     try:
         # Step 1: Download NAIP imagery
         if not skip_naip:
-            logging.info("\n🛰️  Step 1: Downloading NAIP imagery")
+            logger.info("\n🛰️  Step 1: Downloading NAIP imagery")
             if not download_naip_imagery(bbox, zoom, output_dir, max_workers, max_retries):
                 success = False
         else:
-            logging.info("⏭️  Skipping NAIP imagery download")
+            logger.info("⏭️  Skipping NAIP imagery download")
 
         # Step 2: Download forest polygons
         if not skip_polygons and success:
-            logging.info("\n🌳 Step 2: Downloading forest polygons")
+            logger.info("\n🌳 Step 2: Downloading forest polygons")
             if not download_forest_polygons(bbox, output_dir, osm_tag):
                 success = False
         else:
-            logging.info("⏭️  Skipping forest polygons download")
+            logger.info("⏭️  Skipping forest polygons download")
 
         # Step 3: Create mask tiles
         if not skip_masks and not skip_polygons and success:
-            logging.info("\n🎭 Step 3: Creating mask tiles")
+            logger.info("\n🎭 Step 3: Creating mask tiles")
             naip_dir = output_dir / "naip_tiles"
             polygons_file = output_dir / "forest_polygons.geojson"
 
             if not naip_dir.exists():
-                logging.error("NAIP tiles directory not found. Run with NAIP download first.")
+                logger.error("NAIP tiles directory not found. Run with NAIP download first.")
                 success = False
             elif not polygons_file.exists():
-                logging.error("Forest polygons file not found. Run with polygon download first.")
+                logger.error("Forest polygons file not found. Run with polygon download first.")
                 success = False
             else:
-                if not create_mask_tiles(naip_dir, polygons_file, output_dir):
+                if not create_mask_tiles(naip_dir, polygons_file, output_dir, bbox, zoom):
                     success = False
         else:
-            logging.info("⏭️  Skipping mask tile creation")
+            logger.info("⏭️  Skipping mask tile creation")
 
         # Final verification
         if success:
             verify_outputs(output_dir)
 
     except KeyboardInterrupt:
-        logging.info("\n⏹️  Pipeline interrupted by user")
+        logger.info("\n⏹️  Pipeline interrupted by user")
         success = False
     except Exception as e:
-        logging.error(f"Unexpected error: {e}")
+        logger.error("Unexpected error: %s", e)
         success = False
 
     # Summary
     end_time = time.time()
     duration = end_time - start_time
 
-    logging.info("\n" + "=" * 60)
+    logger.info("\n" + "=" * 60)
     if success:
-        logging.info("✅ Forest Trace Pipeline COMPLETED successfully!")
+        logger.info("✅ Forest Trace Pipeline COMPLETED successfully!")
     else:
-        logging.error("❌ Forest Trace Pipeline FAILED!")
+        logger.error("❌ Forest Trace Pipeline FAILED!")
 
-    logging.info(f"Total runtime: {duration:.1f} seconds")
-    logging.info(f"Output directory: {output_dir.absolute()}")
-    logging.info("=" * 60)
+    logger.info("Total runtime: %.1f seconds", duration)
+    logger.info("Output directory: %s", output_dir.absolute())
+    logger.info("=" * 60)
 
     if not success:
         raise RuntimeError("Pipeline execution failed")
@@ -311,7 +309,10 @@ Examples:
     )
 
     parser.add_argument(
-        "--max-retries", type=int, default=2, help="Maximum number of retry attempts for failed tiles (default: 2)"
+        "--max-retries",
+        type=int,
+        default=3,
+        help="Maximum number of retry attempts per failed tile request (default: 3)",
     )
 
     parser.add_argument(
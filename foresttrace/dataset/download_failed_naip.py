@@ -1,22 +1,23 @@
 # foresttrace/foresttrace/dataset/download_failed_naip.py
 
 import argparse
+import asyncio
 from pathlib import Path
 
 import download_naip
 import mercantile
-from tqdm import tqdm
-
-
-def download_failed_naip(failed_file: str, out_dir: Path):
-    failed_tiles = []
-    with open(failed_file, "r") as f:
-        for line in tqdm(f, desc="Processing failed tiles"):
-            zoom, x, y = line.strip().split(",")
-            tile = mercantile.Tile(int(x), int(y), int(zoom))
-            success, tile = download_naip.download_tile(tile, out_dir)
-            if not success:
-                failed_tiles.append(tile)
+import numpy as np
+
+
+def download_failed_naip(failed_file: str, out_dir: Path, max_workers: int = 16):
+    # one "z,x,y" row per failed tile
+    rows = np.loadtxt(failed_file, delimiter=",", dtype=np.int32, ndmin=2)
+    tiles = [mercantile.Tile(int(x), int(y), int(zoom)) for zoom, x, y in rows]
+    failed_tiles = asyncio.run(
+        download_naip.download_tiles(
+            tiles, out_dir, max_workers=max_workers, total=len(tiles), desc="Processing failed tiles"
+        )
+    )
     if failed_tiles:
         print(f"Failed to download {len(failed_tiles)} tiles:")
         for tile in failed_tiles:
@@ -1,56 +1,182 @@
 # foresttrace/foresttrace/dataset/download_naip.py
 
 import argparse
-from concurrent.futures import ThreadPoolExecutor, as_completed
+import asyncio
+from contextlib import closing
 from io import BytesIO
+import os
 from pathlib import Path
+import sqlite3
+from typing import Iterable
 
+import aiohttp
 import mercantile
-from PIL import Image
-import requests
+from tile_index import load_indexed_tiles, open_tile_index, record_tile
 from tqdm import tqdm
 
 TMS_URL = "https://gis.apfo.usda.gov/arcgis/rest/services/NAIP/USDA_CONUS_PRIME/ImageServer/tile/{z}/{y}/{x}"
+REQUEST_TIMEOUT = aiohttp.ClientTimeout(total=10)
+RETRY_STATUSES = {429, 500, 502, 503, 504}
+BACKOFF_FACTOR = 0.5
+MAX_RETRY_AFTER = 60
+PNG_SIGNATURE = b"\x89PNG\r\n\x1a\n"
 
 
-def download_tile(tile: mercantile.Tile, out_dir: Path) -> tuple[bool, mercantile.Tile]:
-    url = TMS_URL.format(z=tile.z, x=tile.x, y=tile.y)
-    try:
-        response = requests.get(url, timeout=10)
-        if response.status_code == 200:
-            img = Image.open(BytesIO(response.content))
-            img.save(out_dir / f"{tile.z}_{tile.x}_{tile.y}.png")
-            return True, tile
-    except Exception:
-        pass
-    return False, tile
+def tile_filename(tile: mercantile.Tile) -> str:
+    return f"{tile.z}_{tile.x}_{tile.y}.png"
 
 
-def download_naip(bbox: tuple[float, float, float, float], zoom: int, out_path: str, max_workers: int = 16) -> None:
-    west, south, east, north = bbox
-    tiles = list(mercantile.tiles(west, south, east, north, zoom))
+def retry_after_seconds(response: aiohttp.ClientResponse) -> float | None:
+    """Delay requested by the server's Retry-After header, if it sent one in seconds"""
+    try:
+        return min(float(response.headers["Retry-After"]), MAX_RETRY_AFTER)
+    except (KeyError, ValueError):
+        return None
+
+
+def save_tile(content: bytes, out_path: Path) -> int:
+    """Save a tile response as a PNG, returning the size in bytes of the file written"""
+    # write to a temporary file and move it into place, so a run killed mid-write never leaves a truncated
+    # tile behind that later runs would skip as already downloaded
+    tmp_path = out_path.with_name(out_path.name + ".tmp")
+    if content.startswith(PNG_SIGNATURE):
+        # already a PNG, write it as-is rather than decoding and re-encoding
+        size = tmp_path.write_bytes(content)
+    else:
+        # only non-PNG responses need Pillow, so don't pay for importing it otherwise
+        from PIL import Image
+
+        img = Image.open(BytesIO(content))
+        img.save(tmp_path, format="PNG")
+        size = tmp_path.stat().st_size
+    os.replace(tmp_path, out_path)
+    return size
+
+
+async def download_tile(
+    session: aiohttp.ClientSession,
+    tile: mercantile.Tile,
+    out_dir: Path,
+    max_retries: int = 3,
+    index: sqlite3.Connection | None = None,
+) -> tuple[bool, mercantile.Tile]:
+    url = TMS_URL.format(z=tile.z, x=tile.x, y=tile.y)
+    retry_after = None
+    for attempt in range(max_retries + 1):
+        if attempt:
+            # honor the server's Retry-After, otherwise back off exponentially: 0.5s, 1s, 2s, ...
+            await asyncio.sleep(retry_after if retry_after is not None else BACKOFF_FACTOR * 2 ** (attempt - 1))
+            retry_after = None
+        try:
+            async with session.get(url, timeout=REQUEST_TIMEOUT) as response:
+                if response.status == 200:
+                    content = await response.read()
+                    # file writes are blocking, keep them off the event loop
+                    loop = asyncio.get_running_loop()
+                    size = await loop.run_in_executor(None, save_tile, content, out_dir / tile_filename(tile))
+                    if index is not None:
+                        # record the saved PNG's size, the same thing the on-disk backfill measures
+                        record_tile(index, tile.z, tile.x, tile.y, size)
+                    return True, tile
+                if response.status not in RETRY_STATUSES:
+                    break
+                retry_after = retry_after_seconds(response)
+        except (aiohttp.ClientError, asyncio.TimeoutError):
+            continue
+        except Exception:
+            break
+    return False, tile
 
-    out_dir = Path(out_path)
-    out_dir.mkdir(parents=True, exist_ok=True)
 
+async def download_tiles(
+    tiles: Iterable[mercantile.Tile],
+    out_dir: Path,
+    max_workers: int = 16,
+    max_retries: int = 3,
+    total: int | None = None,
+    desc: str = "Downloading NAIP tiles",
+) -> list[mercantile.Tile]:
+    """Download tiles concurrently over a shared keep-alive connection pool, returning the failed tiles
+
+    Each downloaded tile is recorded in the directory's tile index, flagging blank (no imagery) tiles.
+    """
+    semaphore = asyncio.Semaphore(max_workers)
+    connector = aiohttp.TCPConnector(limit=max_workers, limit_per_host=max_workers, ttl_dns_cache=600)
     failed_tiles = []
 
-    with ThreadPoolExecutor(max_workers=max_workers) as executor:
-        futures = [executor.submit(download_tile, tile, out_dir) for tile in tiles]
-        with tqdm(total=len(futures), desc="Downloading NAIP tiles") as pbar:
-            for future in as_completed(futures):
-                success, tile = future.result()
+    async with aiohttp.ClientSession(connector=connector) as session:
+        with closing(open_tile_index(out_dir)) as index, tqdm(total=total, desc=desc) as pbar:
+
+            async def bound_download(tile: mercantile.Tile) -> None:
+                try:
+                    success, tile = await download_tile(session, tile, out_dir, max_retries=max_retries, index=index)
+                finally:
+                    semaphore.release()
                 if not success:
                     failed_tiles.append(tile)
                 pbar.update(1)
-    print(f"✓ {len(tiles) - len(failed_tiles)}/{len(tiles)} tiles downloaded successfully")
 
+            # pull tiles lazily so at most max_workers downloads are in flight at a time
+            pending = set()
+            try:
+                for tile in tiles:
+                    await semaphore.acquire()
+                    task = asyncio.create_task(bound_download(tile))
+                    pending.add(task)
+                    task.add_done_callback(pending.discard)
+                await asyncio.gather(*pending)
+            finally:
+                # keep what was recorded even if the run is interrupted, the saved files won't be fetched again
+                index.commit()
+
+    return failed_tiles
+
+
+def download_naip(
+    bbox: tuple[float, float, float, float], zoom: int, out_path: str, max_workers: int = 16, max_retries: int = 3
+) -> list[mercantile.Tile]:
+    west, south, east, north = bbox
+
+    out_dir = Path(out_path)
+    out_dir.mkdir(parents=True, exist_ok=True)
+
+    # list the directory once instead of stat-ing every tile path
+    existing = {p.name for p in out_dir.iterdir()}
+
+    # walk the tile grid once, collecting the tiles still to download. Tiles saved by a run that was killed before
+    # committing, or before the index existed, were never recorded, so index them from their size on disk.
+    missing = []
+    skipped = 0
+    with closing(open_tile_index(out_dir)) as index:
+        indexed = load_indexed_tiles(index)
+        for t in mercantile.tiles(west, south, east, north, zoom):
+            name = tile_filename(t)
+            if name not in existing:
+                missing.append(t)
+                continue
+            skipped += 1
+            if (t.z, t.x, t.y) not in indexed:
+                record_tile(index, t.z, t.x, t.y, (out_dir / name).stat().st_size)
+        index.commit()
+    if skipped:
+        print(f"Skipping {skipped} tiles already downloaded")
+
+    failed_tiles = asyncio.run(
+        download_tiles(missing, out_dir, max_workers=max_workers, max_retries=max_retries, total=len(missing))
+    )
+    print(f"✓ {len(missing) - len(failed_tiles)}/{len(missing)} tiles downloaded successfully")
+
+    fail_log = out_dir / "failed_tiles.txt"
     if failed_tiles:
-        fail_log = out_dir / "failed_tiles.txt"
         with open(fail_log, "w") as f:
             for tile in failed_tiles:
                 f.write(f"{tile.z},{tile.x},{tile.y}\n")
         print(f"⚠ Failed tiles logged to {fail_log}")
+    else:
+        # clear out the log left behind by an earlier partial run
+        fail_log.unlink(missing_ok=True)
+
+    return failed_tiles
 
 
 def main():
@@ -79,11 +205,17 @@ def main():
         "--max-workers",
         type=int,
         default=16,
-        help="Maximum number of concurrent workers (default: 16)",
+        help="Maximum number of concurrent downloads (default: 16)",
+    )
+    parser.add_argument(
+        "--max-retries",
+        type=int,
+        default=3,
+        help="Maximum number of retry attempts per tile (default: 3)",
     )
     args = parser.parse_args()
 
-    download_naip(tuple(args.bbox), args.zoom, args.out, max_workers=args.max_workers)
+    download_naip(tuple(args.bbox), args.zoom, args.out, max_workers=args.max_workers, max_retries=args.max_retries)
 
 
 if __name__ == "__main__":
@@ -1,23 +1,76 @@
 # foresttrace/foresttrace/dataset/download_osm.py
 
 import argparse
+from concurrent.futures import ThreadPoolExecutor
+import math
 from pathlib import Path
 
+import geopandas as gpd
+import numpy as np
 import osmnx as ox
+import pandas as pd
+import shapely
 
+# Size in degrees of the sub-bboxes requested from Overpass
+GRID_SIZE = 0.1
 
-def download_osm(bbox: tuple[float, float, float, float], tag_key: str, tag_value: str, output_path: Path) -> None:
+
+def split_bbox(
+    bbox: tuple[float, float, float, float], step: float = GRID_SIZE
+) -> list[tuple[float, float, float, float]]:
+    """Split a bbox into a grid of sub-bboxes no larger than step x step degrees"""
+    west, south, east, north = bbox
+    n_cols = max(1, math.ceil((east - west) / step))
+    n_rows = max(1, math.ceil((north - south) / step))
+    col_width = (east - west) / n_cols
+    row_height = (north - south) / n_rows
+
+    return [
+        (
+            west + i * col_width,
+            south + j * row_height,
+            west + (i + 1) * col_width,
+            south + (j + 1) * row_height,
+        )
+        for i in range(n_cols)
+        for j in range(n_rows)
+    ]
+
+
+def download_osm_bbox(bbox: tuple[float, float, float, float], tags: dict[str, str]) -> gpd.GeoDataFrame | None:
+    """Download features for a single sub-bbox, or None if Overpass has nothing there"""
+    try:
+        return ox.features.features_from_bbox(bbox, tags=tags)
+    except ox._errors.InsufficientResponseError:
+        return None
+
+
+def download_osm(
+    bbox: tuple[float, float, float, float], tag_key: str, tag_value: str, output_path: Path, max_workers: int = 4
+) -> None:
     tags = {tag_key: tag_value}
 
-    gdf = ox.features.features_from_bbox(bbox, tags=tags)
-    gdf = gdf[gdf["geometry"].type.isin(["Polygon", "MultiPolygon"])]
+    # Smaller requests avoid Overpass timeouts on large bboxes, and Overpass
+    # tolerates a few of them in parallel. The sub-bboxes are deterministic, so
+    # with osmnx's response cache (on by default) reruns don't hit the server again
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        gdfs = [gdf for gdf in executor.map(lambda b: download_osm_bbox(b, tags), split_bbox(bbox)) if gdf is not None]
+
+    if not gdfs:
+        raise ValueError(f"No OSM features found for {tag_key}={tag_value} in bbox {bbox}")
+
+    gdf = pd.concat(gdfs)
+    # Features crossing sub-bbox edges are returned once per sub-bbox, dedupe on the (element, id) index
+    gdf = gdf[~gdf.index.duplicated()]
+    type_ids = shapely.get_type_id(gdf.geometry.to_numpy())
+    gdf = gdf[np.isin(type_ids, [shapely.GeometryType.POLYGON, shapely.GeometryType.MULTIPOLYGON])]
 
     out_path = Path(output_path)
     out_path.parent.mkdir(parents=True, exist_ok=True)
-    gdf.to_file(out_path, driver="GeoJSON")
+    gdf.to_file(out_path, driver="GeoJSON", engine="pyogrio")
 
 
-def main(bbox: tuple[float, float, float, float], tag_key: str, tag_value: str, output_path: Path) -> None:
+def main() -> None:
     parser = argparse.ArgumentParser(description="Download OpenStreetMap data within a bounding box.")
     parser.add_argument(
         "--bbox",
@@ -39,10 +92,16 @@ def main(bbox: tuple[float, float, float, float], tag_key: str, tag_value: str,
         help="Output GeoJSON file path",
         required=True,
     )
+    parser.add_argument(
+        "--max-workers",
+        type=int,
+        default=4,
+        help="Maximum number of concurrent Overpass requests (default: 4)",
+    )
 
     args = parser.parse_args()
     key, value = args.tag.split("=")
-    download_osm(tuple(args.bbox), key, value, args.out)
+    download_osm(tuple(args.bbox), key, value, args.out, max_workers=args.max_workers)
 
 
 if __name__ == "__main__":
@@ -1,43 +1,98 @@
 import argparse
+from concurrent.futures import ProcessPoolExecutor
+from functools import partial
+import logging
+import math
+import os
 from pathlib import Path
-from typing import Tuple
+import re
+from typing import Callable, Tuple
 
 import geopandas as gpd
 import mercantile
 import numpy as np
+import pyogrio
 import rasterio
+from rasterio.errors import RasterioError
 from rasterio.features import rasterize
-from rasterio.transform import from_bounds
-from rasterio.warp import transform_bounds
+from rasterio.transform import Affine, from_bounds
+import shapely
+from shapely.errors import GEOSException
 from shapely.geometry import box
+from tile_index import load_blank_tiles
 from tqdm import tqdm
 
-
-def load_polygons(geojson_path: Path) -> gpd.GeoDataFrame:
-    """Load polygons and ensure they're in EPSG:4326 (WGS84)"""
-    gdf = gpd.read_file(geojson_path)
-    if gdf.crs != "EPSG:4326":
-        gdf = gdf.to_crs(epsg=4326)
+logger = logging.getLogger(__name__)
+
+# Half the width of the square Web Mercator world, in meters
+WEB_MERCATOR_HALF_WIDTH = math.pi * 6378137.0
+
+# NAIP tiles are saved as {z}_{x}_{y}.png (or .jpg)
+TILE_NAME_PATTERN = re.compile(r"(\d+)_(\d+)_(\d+)\.(?:png|jpg)")
+
+# GeoTIFF profile shared by every mask tile, only the transform differs per tile
+MASK_TILE_PROFILE = {
+    "driver": "GTiff",
+    "height": 256,
+    "width": 256,
+    "count": 1,
+    "dtype": "uint8",
+    "crs": rasterio.CRS.from_epsg(3857),
+    "compress": "lzw",  # Add compression to save space
+}
+
+
+def load_polygons(geojson_path: Path, bounds: Tuple[float, float, float, float] | None = None) -> gpd.GeoDataFrame:
+    """Load polygons, repair invalid geometries and reproject once to Web Mercator (EPSG:3857),
+    dropping any polygons outside the optional Web Mercator bounds"""
+    # Let GDAL skip features outside the bounds while reading, it reprojects the bbox to the file's CRS
+    bbox = gpd.GeoSeries([box(*bounds)], crs="EPSG:3857") if bounds is not None else None
+    gdf = gpd.read_file(geojson_path, engine="pyogrio", bbox=bbox)
+    gdf = gdf.set_geometry(gdf.make_valid())
+    if gdf.crs != "EPSG:3857":
+        gdf = gdf.to_crs(epsg=3857)
+    if bounds is not None:
+        gdf = gdf[gdf.intersects(box(*bounds))]
     return gdf
 
 
-def get_tile_bounds_web_mercator(tile: mercantile.Tile) -> Tuple[float, float, float, float]:
-    """Get tile bounds in Web Mercator (EPSG:3857)"""
-    # Get bounds in WGS84
-    bounds_wgs84 = mercantile.bounds(tile)
+def get_tile_resolution_web_mercator(zoom: int) -> float:
+    """Get the size in Web Mercator meters of one pixel of a 256x256 tile at the given zoom"""
+    return 2 * WEB_MERCATOR_HALF_WIDTH / (256 * 2**zoom)
 
-    # Transform to Web Mercator
-    bounds_3857 = transform_bounds(
-        "EPSG:4326", "EPSG:3857", bounds_wgs84.west, bounds_wgs84.south, bounds_wgs84.east, bounds_wgs84.north
-    )
 
-    return bounds_3857
+def get_tile_origins_web_mercator(xs, ys, resolution: float):
+    """Get the upper-left (west, north) corners in Web Mercator of tiles from their x and y indices,
+    works elementwise on NumPy arrays as well as on scalars"""
+    # Web Mercator tiles form a regular grid in meters, so this is plain arithmetic with no trig
+    tile_size = 256 * resolution
+    return xs * tile_size - WEB_MERCATOR_HALF_WIDTH, WEB_MERCATOR_HALF_WIDTH - ys * tile_size
 
 
-def rasterize_tile(
-    tile: mercantile.Tile, polygons: gpd.GeoDataFrame, out_path: Path, resolution: float = 1.1943285668550503
-) -> None:
-    """Rasterize polygons for a specific tile"""
+def get_tiles_bounds_web_mercator(tiles: list[Tuple[int, int, int]]) -> Tuple[float, float, float, float]:
+    """Get the bounds in Web Mercator (EPSG:3857) covering all (z, x, y) tiles at a single zoom"""
+    zs, xs, ys = np.array(tiles).T
+    resolution = get_tile_resolution_web_mercator(zs[0])
+    west, north = get_tile_origins_web_mercator(xs.min(), ys.min(), resolution)
+    east, south = get_tile_origins_web_mercator(xs.max() + 1, ys.max() + 1, resolution)
+    return float(west), float(south), float(east), float(north)
+
+
+def get_tile_bounds_web_mercator(tile: mercantile.Tile) -> Tuple[float, float, float, float]:
+    """Get tile bounds in Web Mercator (EPSG:3857)"""
+    resolution = get_tile_resolution_web_mercator(tile.z)
+    west, north = get_tile_origins_web_mercator(tile.x, tile.y, resolution)
+    return west, north - 256 * resolution, west + 256 * resolution, north
+
+
+def rasterize_tile_mask(
+    tile: mercantile.Tile,
+    polygons: gpd.GeoDataFrame,
+    sindex: gpd.sindex.SpatialIndex,
+    out: np.ndarray | None = None,
+) -> Tuple[np.ndarray, Affine]:
+    """Rasterize polygons for a specific tile into `out` (a zero-filled 256x256 array, allocated if not given),
+    returning the mask and its transform"""
 
     # Get tile bounds in Web Mercator
     west, south, east, north = get_tile_bounds_web_mercator(tile)
@@ -45,99 +100,281 @@ def rasterize_tile(
     # Create tile geometry in Web Mercator for intersection
     tile_geom_3857 = box(west, south, east, north)
 
-    # Convert polygons to Web Mercator for proper geometric operations
-    polygons_3857 = polygons.to_crs(epsg=3857)
+    # Find polygons that intersect this tile, using the spatial index to narrow the candidates
+    candidate_idx = sindex.query(tile_geom_3857, predicate="intersects")
+    clipped = polygons.iloc[candidate_idx]
 
-    # Find polygons that intersect this tile
-    clipped = polygons_3857[polygons_3857.intersects(tile_geom_3857)]
+    # Create transform for 256x256 pixels. Every tile at a zoom level has the same pixel size,
+    # so build the affine directly from the tile origin instead of going through from_bounds.
+    resolution = get_tile_resolution_web_mercator(tile.z)
+    transform = Affine(resolution, 0.0, west, 0.0, -resolution, north)
 
-    # Create transform for 256x256 pixels
-    transform = from_bounds(west, south, east, north, 256, 256)
+    mask = np.zeros((256, 256), dtype=np.uint8) if out is None else out
 
     if clipped.empty:
         # No polygons in this tile
-        mask = np.zeros((256, 256), dtype=np.uint8)
-    else:
-        # Clip polygons to tile bounds and rasterize
-        clipped_geoms = []
-        for geom in clipped.geometry:
-            try:
-                intersected = geom.intersection(tile_geom_3857)
-                if not intersected.is_empty:
-                    clipped_geoms.append((intersected, 1))
-            except Exception:
-                # Skip problematic geometries
-                continue
+        return mask, transform
 
-        if clipped_geoms:
-            mask = rasterize(
-                clipped_geoms,
-                out_shape=(256, 256),
-                transform=transform,
-                fill=0,
-                dtype="uint8",
-                all_touched=True,  # This helps capture thin polygons
-            )
-        else:
-            mask = np.zeros((256, 256), dtype=np.uint8)
+    if shapely.covers(clipped.geometry.to_numpy(), tile_geom_3857).any():
+        # Tile lies entirely inside a polygon, no need to clip or rasterize
+        mask[:] = 1
+        return mask, transform
+
+    # Clip polygons to tile bounds in one vectorized GEOS call and burn them straight into the mask
+    clipped_geoms = shapely.intersection(clipped.geometry.to_numpy(), tile_geom_3857)
+    clipped_geoms = clipped_geoms[~shapely.is_empty(clipped_geoms)]
+
+    if len(clipped_geoms):
+        rasterize(
+            ((geom, 1) for geom in clipped_geoms),
+            out=mask,
+            transform=transform,
+            all_touched=True,  # This helps capture thin polygons
+        )
+
+    return mask, transform
+
+
+def rasterize_tile(
+    tile: mercantile.Tile,
+    polygons: gpd.GeoDataFrame,
+    sindex: gpd.sindex.SpatialIndex,
+    out_path: Path,
+    skip_empty: bool = False,
+    out: np.ndarray | None = None,
+) -> bool:
+    """Rasterize polygons for a specific tile, returning False if the mask was empty and skipped"""
+    mask, transform = rasterize_tile_mask(tile, polygons, sindex, out=out)
+
+    if skip_empty and not mask.any():
+        return False
 
     # Save with proper georeferencing
+    with rasterio.open(out_path, "w", transform=transform, **MASK_TILE_PROFILE) as dst:
+        dst.write(mask, 1)
+    return True
+
+
+# Per-worker polygon state, populated once by _worker_init in each pool process
+_polygons: gpd.GeoDataFrame | None = None
+_sindex: gpd.sindex.SpatialIndex | None = None
+# Memory-mapped mosaic and the (x, y) of its upper-left tile, only set when writing a mosaic
+_mosaic: np.memmap | None = None
+_mosaic_origin: Tuple[int, int] = (0, 0)
+# Scratch mask reused for every tile a worker writes, GDAL copies it on write so it's safe to overwrite
+_mask_buffer = np.zeros((256, 256), dtype=np.uint8)
+
+
+def _worker_init(
+    polygon_path: Path,
+    bounds: Tuple[float, float, float, float],
+    mosaic: Tuple[Path, Tuple[int, int], Tuple[int, int]] | None = None,
+) -> None:
+    """Load polygons and build the spatial index once per worker process"""
+    global _polygons, _sindex, _mosaic, _mosaic_origin
+    _polygons = load_polygons(polygon_path, bounds)
+    _sindex = _polygons.sindex
+    # Prepare geometries in place so the per-tile covers checks reuse their GEOS indexes
+    shapely.prepare(_polygons.geometry.to_numpy())
+    if mosaic is not None:
+        mosaic_path, shape, _mosaic_origin = mosaic
+        _mosaic = np.memmap(mosaic_path, dtype=np.uint8, mode="r+", shape=shape)
+
+
+def _worker_rasterize(tile: Tuple[int, int, int], output_dir: Path, skip_empty: bool = False) -> bool:
+    z, x, y = tile
+    tile = mercantile.Tile(x=x, y=y, z=z)
+    _mask_buffer.fill(0)
+    return rasterize_tile(tile, _polygons, _sindex, output_dir / f"{z}_{x}_{y}_mask.tif", skip_empty, out=_mask_buffer)
+
+
+def _worker_rasterize_into_mosaic(tile: Tuple[int, int, int]) -> bool:
+    z, x, y = tile
+    # Tiles never overlap, so workers can burn into their own slice of the shared mapping without locking
+    row_off = (y - _mosaic_origin[1]) * 256
+    col_off = (x - _mosaic_origin[0]) * 256
+    out = _mosaic[row_off : row_off + 256, col_off : col_off + 256]
+    rasterize_tile_mask(mercantile.Tile(x=x, y=y, z=z), _polygons, _sindex, out=out)
+    return True
+
+
+def _worker_try(work: Callable[[Tuple[int, int, int]], bool], tile: Tuple[int, int, int]) -> Tuple[bool, str | None]:
+    """Run work on a tile, returning its result and the error instead of raising so one bad tile doesn't abort
+    the whole map"""
+    # Only geometry and raster I/O errors are expected per tile, anything else is a bug and should surface
+    try:
+        return work(tile), None
+    except (GEOSException, RasterioError, OSError) as e:
+        return False, str(e)
+
+
+def write_mask_mosaic(out_path: Path, mosaic: np.ndarray, bounds: Tuple[float, float, float, float]) -> None:
+    """Write a mosaic of masks as a single tiled GeoTIFF, with one 256x256 internal block per tile"""
+    height, width = mosaic.shape
     profile = {
         "driver": "GTiff",
-        "height": 256,
-        "width": 256,
+        "height": height,
+        "width": width,
         "count": 1,
         "dtype": "uint8",
         "crs": "EPSG:3857",
-        "transform": transform,
-        "compress": "lzw",  # Add compression to save space
+        "transform": from_bounds(*bounds, width, height),
+        "tiled": True,
+        "blockxsize": 256,
+        "blockysize": 256,
+        # Deflate packs the long runs of 0s and 1s in a mask to well under half the size LZW does
+        "compress": "deflate",
+        "BIGTIFF": "IF_SAFER",
+        # Compress blocks on all cores rather than one at a time
+        "num_threads": "ALL_CPUS",
     }
+    # A larger block cache lets GDAL hold the whole write in memory and compress it in parallel,
+    # instead of flushing blocks one by one through the small default cache
+    with rasterio.Env(GDAL_CACHEMAX=512), rasterio.open(out_path, "w", **profile) as dst:
+        dst.write(mosaic, 1)
+
+
+def polygons_to_mask_tiles(
+    tile_dir: Path,
+    polygon_path: Path,
+    output_dir: Path,
+    bbox: Tuple[float, float, float, float] | None = None,
+    zoom: int = 17,
+    max_workers: int | None = None,
+    mosaic: bool = False,
+    skip_empty: bool = False,
+    tile_manifest: Path | None = None,
+) -> None:
+    """Main function to process all tiles, optionally writing them into a single mosaic GeoTIFF
 
-    with rasterio.open(out_path, "w", **profile) as dst:
-        dst.write(mask, 1)
-
-
-def polygons_to_mask_tiles(tile_dir: Path, polygon_path: Path, output_dir: Path) -> None:
-    """Main function to process all tiles"""
+    With skip_empty, tiles whose mask is all zero aren't written and are listed in empty_tiles.txt instead.
+    A tile_manifest of z,x,y lines (like failed_tiles.txt) lists the tiles directly, without touching tile_dir.
+    """
 
-    print("Loading polygons...")
-    polygons = load_polygons(polygon_path)
-    print(f"Loaded {len(polygons)} polygons in CRS: {polygons.crs}")
+    # Polygons are only loaded inside the pool workers, so check the file is readable up front to fail
+    # with one clear error here rather than a traceback per worker and a BrokenProcessPool
+    pyogrio.read_info(polygon_path)
 
     output_dir.mkdir(parents=True, exist_ok=True)
 
-    # Find all NAIP tile files
-    tile_files = list(tile_dir.glob("*.png")) + list(tile_dir.glob("*.jpg"))
-    print(f"Found {len(tile_files)} tile files")
-
     successful = 0
     failed = 0
+    empty_tiles = []
+
+    tiles = []
+    if tile_manifest is not None:
+        # The manifest already names every tile, so there's no directory to walk
+        manifest = np.loadtxt(tile_manifest, delimiter=",", dtype=np.int32, ndmin=2)
+        tiles = [tuple(tile) for tile in manifest[manifest[:, 0] == zoom].tolist()]
+        print(f"Found {len(tiles)} tiles in {tile_manifest}")
+    elif bbox is not None:
+        # The tile grid is known up front, so enumerate it directly and keep the tiles that were downloaded
+        west, south, east, north = bbox
+        existing = {p.name for p in tile_dir.iterdir()}
+        for tile in mercantile.tiles(west, south, east, north, zoom):
+            if f"{tile.z}_{tile.x}_{tile.y}.png" in existing:
+                tiles.append((tile.z, tile.x, tile.y))
+        print(f"Found {len(tiles)} tile files")
+    else:
+        # Find all NAIP tile files in a single pass over the directory, keeping only their names
+        with os.scandir(tile_dir) as entries:
+            tile_names = [e.name for e in entries if e.name.endswith((".png", ".jpg")) and e.is_file()]
+        print(f"Found {len(tile_names)} tile files")
 
-    for tile_file in tqdm(tile_files, desc="Rasterizing tiles"):
-        try:
+        for name in tile_names:
             # Parse tile coordinates from filename
-            parts = tile_file.stem.split("_")
-            if len(parts) != 3:
-                print(f"Skipping {tile_file.name}: invalid filename format")
+            match = TILE_NAME_PATTERN.fullmatch(name)
+            if match is None:
+                logger.debug("Skipping %s: invalid filename format", name)
                 failed += 1
                 continue
 
-            z, x, y = map(int, parts)
-
-            if z != 17:
-                print(f"Skipping {tile_file.name}: not zoom level 17")
+            z, x, y = map(int, match.groups())
+            if z != zoom:
+                logger.debug("Skipping %s: not zoom level %s", name, zoom)
                 failed += 1
                 continue
 
-            tile = mercantile.Tile(x=x, y=y, z=z)
-            out_path = output_dir / f"{z}_{x}_{y}_mask.tif"
-
-            rasterize_tile(tile, polygons, out_path)
-            successful += 1
-
-        except Exception as e:
-            print(f"Failed to process tile {tile_file.name}: {e}")
-            failed += 1
+            tiles.append((z, x, y))
+
+    # NAIP tiles with no imagery have nothing to learn from, so don't make masks for them
+    blank_tiles = load_blank_tiles(tile_dir)
+    if blank_tiles:
+        n_tiles = len(tiles)
+        tiles = [tile for tile in tiles if tile not in blank_tiles]
+        print(f"Skipping {n_tiles - len(tiles)} blank tiles")
+
+    if not tiles:
+        print("No tiles to rasterize")
+        return
+
+    # Walk the tiles row by row (y, then x) so each chunk a worker gets covers a contiguous strip: neighbouring
+    # tiles share candidate polygons, and in mosaic mode the chunk writes into adjacent rows of the memmap
+    tiles.sort(key=lambda t: (t[2], t[1]))
+
+    # Only polygons touching the tile grid matter, so drop the rest before indexing
+    bounds = get_tiles_bounds_web_mercator(tiles)
+
+    max_workers = max_workers or os.cpu_count()
+    print(f"Loading polygons in {max_workers} worker processes...")
+
+    mosaic_args = None
+    if mosaic:
+        # Workers rasterize straight into a memory-mapped array covering all tiles, which is
+        # compressed into a single GeoTIFF once every tile is done
+        min_x = min(x for _, x, _ in tiles)
+        min_y = min(y for _, _, y in tiles)
+        shape = ((max(y for _, _, y in tiles) - min_y + 1) * 256, (max(x for _, x, _ in tiles) - min_x + 1) * 256)
+        memmap_path = output_dir / "mask_mosaic.dat"
+        np.memmap(memmap_path, dtype=np.uint8, mode="w+", shape=shape).flush()
+        mosaic_args = (memmap_path, shape, (min_x, min_y))
+
+    try:
+        # Rasterization is CPU bound, so fan tiles out across processes. Each worker
+        # loads and indexes the polygons once in its initializer rather than per tile.
+        with ProcessPoolExecutor(
+            max_workers=max_workers, initializer=_worker_init, initargs=(polygon_path, bounds, mosaic_args)
+        ) as pool:
+            if mosaic:
+                work = _worker_rasterize_into_mosaic
+            else:
+                work = partial(_worker_rasterize, output_dir=output_dir, skip_empty=skip_empty)
+            # Hand tiles to the workers in chunks rather than paying an IPC round trip per tile
+            chunksize = max(1, len(tiles) // (4 * max_workers))
+            results = pool.map(partial(_worker_try, work), tiles, chunksize=chunksize)
+            # Results arrive a chunk at a time, so redraw the bar at most every half second or 0.1% of tiles
+            progress = tqdm(
+                zip(tiles, results),
+                total=len(tiles),
+                desc="Rasterizing tiles",
+                mininterval=0.5,
+                miniters=max(1, len(tiles) // 1000),
+            )
+            for (z, x, y), (written, error) in progress:
+                if error is not None:
+                    logger.warning("Failed to process tile %s_%s_%s: %s", z, x, y, error)
+                    failed += 1
+                    continue
+                if not written:
+                    empty_tiles.append((z, x, y))
+                successful += 1
+
+        if mosaic:
+            mosaic_path = output_dir / "mask_mosaic.tif"
+            print(f"Writing masks into {mosaic_path}")
+            write_mask_mosaic(mosaic_path, np.memmap(memmap_path, dtype=np.uint8, mode="r", shape=shape), bounds)
+    finally:
+        if mosaic:
+            # Drop the uncompressed scratch mosaic even if rasterizing or writing failed
+            memmap_path.unlink(missing_ok=True)
+
+    if skip_empty and not mosaic:
+        # Keep a record of the skipped tiles so they can still be enumerated, e.g. as all-background samples
+        empty_log = output_dir / "empty_tiles.txt"
+        with open(empty_log, "w") as f:
+            for z, x, y in empty_tiles:
+                f.write(f"{z},{x},{y}\n")
+        print(f"Skipped writing {len(empty_tiles)} empty masks, listed in {empty_log}")
 
     print(f"\n✓ Successfully processed {successful} tiles")
     if failed > 0:
@@ -166,9 +403,56 @@ def main() -> None:
         required=True,
         help="Directory to save raster mask tiles",
     )
+    parser.add_argument(
+        "--bbox",
+        type=float,
+        nargs=4,
+        metavar=("WEST", "SOUTH", "EAST", "NORTH"),
+        default=None,
+        help="Bounding box the NAIP tiles were downloaded for. If given, tiles are enumerated from it "
+        "instead of scanning the tile directory",
+    )
+    parser.add_argument(
+        "--tile-manifest",
+        type=str,
+        default=None,
+        help="Text file listing the tiles to rasterize as z,x,y lines. If given, the tile directory isn't scanned",
+    )
+    parser.add_argument(
+        "--zoom",
+        type=int,
+        default=17,
+        help="Zoom level of the NAIP tiles (default: 17)",
+    )
+    parser.add_argument(
+        "--max-workers",
+        type=int,
+        default=None,
+        help="Number of worker processes (default: number of CPUs)",
+    )
+    parser.add_argument(
+        "--mosaic",
+        action="store_true",
+        help="Write all masks into a single tiled GeoTIFF (mask_mosaic.tif) instead of one file per tile",
+    )
+    parser.add_argument(
+        "--skip-empty",
+        action="store_true",
+        help="Don't write masks with no forest, list them in empty_tiles.txt instead. Ignored with --mosaic",
+    )
     args = parser.parse_args()
 
-    polygons_to_mask_tiles(Path(args.tiles), Path(args.polygons), Path(args.out))
+    polygons_to_mask_tiles(
+        Path(args.tiles),
+        Path(args.polygons),
+        Path(args.out),
+        bbox=tuple(args.bbox) if args.bbox else None,
+        zoom=args.zoom,
+        max_workers=args.max_workers,
+        mosaic=args.mosaic,
+        skip_empty=args.skip_empty,
+        tile_manifest=Path(args.tile_manifest) if args.tile_manifest else None,
+    )
 
 
 if __name__ == "__main__":
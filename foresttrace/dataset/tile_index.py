@@ -0,0 +1,42 @@
+# foresttrace/foresttrace/dataset/tile_index.py
+
+from contextlib import closing
+from pathlib import Path
+import sqlite3
+
+INDEX_NAME = "index.sqlite"
+# Tiles are sized as the PNG saved to disk (JPEG responses are re-encoded first). A uniform (nodata / all black)
+# 256x256 PNG compresses to a few hundred bytes, real NAIP imagery is tens of KB
+BLANK_TILE_MAX_BYTES = 1024
+
+
+def open_tile_index(tile_dir: Path) -> sqlite3.Connection:
+    """Open the index of downloaded tiles in tile_dir, creating it if needed"""
+    conn = sqlite3.connect(tile_dir / INDEX_NAME)
+    conn.execute(
+        "CREATE TABLE IF NOT EXISTS tiles ("
+        "z INTEGER, x INTEGER, y INTEGER, size INTEGER, is_blank INTEGER, PRIMARY KEY (z, x, y))"
+    )
+    return conn
+
+
+def record_tile(conn: sqlite3.Connection, z: int, x: int, y: int, size: int) -> None:
+    """Record a downloaded tile from the size of its saved PNG, flagging it blank if small enough to hold no imagery"""
+    conn.execute(
+        "INSERT OR REPLACE INTO tiles (z, x, y, size, is_blank) VALUES (?, ?, ?, ?, ?)",
+        (z, x, y, size, size <= BLANK_TILE_MAX_BYTES),
+    )
+
+
+def load_indexed_tiles(conn: sqlite3.Connection) -> set[tuple[int, int, int]]:
+    """Get the (z, x, y) of every tile recorded in the index"""
+    return set(conn.execute("SELECT z, x, y FROM tiles"))
+
+
+def load_blank_tiles(tile_dir: Path) -> set[tuple[int, int, int]]:
+    """Get the (z, x, y) of tiles flagged blank in tile_dir's index, empty if there is no index"""
+    index_path = tile_dir / INDEX_NAME
+    if not index_path.exists():
+        return set()
+    with closing(sqlite3.connect(index_path)) as conn:
+        return set(conn.execute("SELECT z, x, y FROM tiles WHERE is_blank"))